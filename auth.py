@@ -0,0 +1,154 @@
+import threading
+import click
+import time
+from flask import current_app, request
+from flask_jwt_extended import JWTManager, verify_jwt_in_request
+from flask_login import LoginManager, UserMixin
+from sqlalchemy import event, inspect, text
+
+from models import db, User
+
+jwt = JWTManager()
+login_manager = LoginManager()
+
+# Endpoints reachable without a token while auth is enabled
+PUBLIC_ENDPOINTS = {'create_user', 'login'}
+
+# Identity fields of a loaded user, safe to share between requests
+class AuthUser(UserMixin):
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+# Users loaded for authentication, keyed by id: (expires_at, AuthUser).
+# This is per process and invalidated when a commit updates or deletes a user.
+# The generation counts invalidations, so a load that raced with a commit is
+# not cached.
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+_user_cache_generation = 0
+
+# Placeholder secret shipped in run.py, never valid for signing tokens
+DEFAULT_SECRET_KEY = 'your_secret_key_here'
+
+# Shortest HMAC key PyJWT accepts for HS256 without a warning
+MIN_SECRET_KEY_BYTES = 32
+
+# Set up JWT verification and the login manager. Call after db.init_app(app).
+def init_auth(app):
+    app.config.setdefault('AUTH_ENABLED', False)
+    app.config.setdefault('JWT_SECRET_KEY', None)
+    app.config.setdefault('AUTH_USER_CACHE_SECONDS', 60)
+    app.config.setdefault('AUTH_USER_CACHE_SIZE', 1024)
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+
+    # Tokens must not be signed with a key anyone reading the repo can see
+    if app.config['AUTH_ENABLED']:
+        secret_key = app.config['JWT_SECRET_KEY']
+        if not secret_key or secret_key == DEFAULT_SECRET_KEY:
+            raise RuntimeError('Set JWT_SECRET_KEY to a private value when AUTH_ENABLED is on')
+        if len(secret_key.encode()) < MIN_SECRET_KEY_BYTES:
+            raise RuntimeError('JWT_SECRET_KEY must be at least %d bytes long' % MIN_SECRET_KEY_BYTES)
+
+        # Hashes from the configured method must fit the deployed column
+        with app.app_context():
+            check_password_column()
+
+    jwt.init_app(app)
+    login_manager.init_app(app)
+    app.before_request(require_token)
+    app.cli.command('upgrade-password-column')(upgrade_password_column)
+
+# Length of the user.password column, as deployed where the database enforces it
+def password_column_length():
+    length = User.__table__.c.password.type.length
+    if db.engine.dialect.name == 'sqlite' or not inspect(db.engine).has_table(User.__tablename__):
+        # SQLite ignores VARCHAR lengths and create_all builds missing tables from the model
+        return length
+    columns = {column['name']: column['type'] for column in inspect(db.engine).get_columns(User.__tablename__)}
+    return min(length, columns['password'].length or length)
+
+# Refuse hash methods whose hashes would not fit the password column, which
+# create_all never widens on existing tables
+def check_password_column():
+    hash_length = len(User.dummy_password_hash())
+    column_length = password_column_length()
+    if hash_length > column_length:
+        raise RuntimeError(
+            '%s hashes are %d characters but user.password holds %d. Run '
+            '"AUTH_ENABLED=0 flask --app run upgrade-password-column" or choose a shorter PASSWORD_HASH_METHOD'
+            % (current_app.config['PASSWORD_HASH_METHOD'], hash_length, column_length))
+
+# Widen user.password on existing Postgres databases to the model's length
+def upgrade_password_column():
+    length = User.__table__.c.password.type.length
+    if db.engine.dialect.name == 'sqlite':
+        click.echo('SQLite does not enforce VARCHAR lengths, nothing to do')
+        return
+    with db.engine.begin() as connection:
+        connection.execute(text('ALTER TABLE "user" ALTER COLUMN password TYPE VARCHAR(%d)' % length))
+    click.echo('user.password widened to VARCHAR(%d)' % length)
+
+# Validate the request's JWT. Decoding is stateless and the user comes from the TTL cache.
+def require_token():
+    if not current_app.config['AUTH_ENABLED']:
+        return
+    if request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return
+    verify_jwt_in_request()
+
+# Load a user through the TTL cache, hitting the database only on a miss
+@login_manager.user_loader
+def load_user(user_id):
+    user_id = int(user_id)
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        generation = _user_cache_generation
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    auth_user = AuthUser(user.id, user.username, user.email)
+
+    with _user_cache_lock:
+        if generation != _user_cache_generation:
+            return auth_user
+        # Evict the oldest entry when the cache is full
+        if user_id not in _user_cache and len(_user_cache) >= current_app.config['AUTH_USER_CACHE_SIZE']:
+            _user_cache.pop(next(iter(_user_cache)), None)
+        _user_cache[user_id] = (now + current_app.config['AUTH_USER_CACHE_SECONDS'], auth_user)
+    return auth_user
+
+# Resolve flask_jwt_extended's current_user through the same cache
+@jwt.user_lookup_loader
+def load_jwt_user(jwt_header, jwt_data):
+    return load_user(jwt_data['sub'])
+
+# Collect the users each flush updates or deletes
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_users(session, flush_context):
+    changed = session.info.setdefault('changed_user_ids', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.id)
+
+# Invalidate only once the change is committed, so a concurrent miss cannot
+# reload and cache the old row
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cached_users(session):
+    global _user_cache_generation
+    changed = session.info.pop('changed_user_ids', ())
+    if not changed:
+        return
+    with _user_cache_lock:
+        _user_cache_generation += 1
+        for user_id in changed:
+            _user_cache.pop(user_id, None)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_changed_users(session):
+    session.info.pop('changed_user_ids', None)
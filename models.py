@@ -1,9 +1,13 @@
+import hmac
+import secrets
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime, timedelta
 from sqlalchemy.orm import relationship, mapped_column
 from sqlalchemy import LargeBinary
 from flask_jwt_extended import create_access_token
+from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
@@ -12,27 +16,50 @@ class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(128), nullable=False)
+    password = db.Column(db.String(256), nullable=False)
 
     # Relationships
     transactions = db.relationship('Transaction', backref='user', lazy=True)
     accounts = db.relationship('Account', backref='user', lazy=True)
     budgets = db.relationship('Budget', backref='user', lazy=True)
     
+    # Hash of a random password with the configured method, built on first use
+    # since hashing is slow. Its prefix is the method spec werkzeug actually
+    # writes, which expands short specs such as 'scrypt' to 'scrypt:32768:8:1'.
+    @staticmethod
+    def dummy_password_hash():
+        config = current_app.config
+        if 'PASSWORD_DUMMY_HASH' not in config:
+            config['PASSWORD_DUMMY_HASH'] = generate_password_hash(secrets.token_hex(16), method=config['PASSWORD_HASH_METHOD'])
+        return config['PASSWORD_DUMMY_HASH']
+
+    def set_password(self, password):
+        self.password = generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+    # Check a password, rehashing legacy plaintext or outdated-cost hashes on success
+    def check_password(self, password):
+        if self.password.startswith(('pbkdf2:', 'scrypt:')):
+            matches = check_password_hash(self.password, password)
+        else:
+            matches = hmac.compare_digest(self.password.encode(), password.encode())
+        if matches and self.password.split('$', 1)[0] != User.dummy_password_hash().split('$', 1)[0]:
+            self.set_password(password)
+        return matches
+
     def generate_access_token(self):
-        return create_access_token(identity=self.id)
+        return create_access_token(identity=str(self.id))
     
 # Define the UserProfile model
 class UserProfile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     profile_picture = db.Column(db.LargeBinary(), nullable=False)
     first_name = db.Column(db.String(100))
     last_name = db.Column(db.String(100))
     phone_number = db.Column(db.String(100))
 
     # Create a one-to-one relationship between the User and UserProfile models
-    user = db.relationship('UserProfile', backref='user', uselist=False)
+    user = db.relationship('User', backref=db.backref('profile', uselist=False))
     
 # Category Model
 class Category(db.Model):
@@ -42,11 +69,11 @@ class Category(db.Model):
 # Transaction Model
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     transaction_date = db.Column(db.DateTime, nullable=False)
     description = db.Column(db.String(255), nullable=False)
     # category = db.Column(db.String(80), nullable=False)
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False, index=True)
     amount = db.Column(db.Float, nullable=False)
     is_income = db.Column(db.Boolean, nullable=False)  # True for income, False for expense
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -55,7 +82,7 @@ class Transaction(db.Model):
 # Account Model
 class Account(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     account_name = db.Column(db.String(80), nullable=False)
     account_type = db.Column(db.String(80), nullable=False)
     balance = db.Column(db.Float, nullable=False)
@@ -63,7 +90,7 @@ class Account(db.Model):
 # Budget Model
 class Budget(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     category = db.Column(db.String(80), nullable=False)
     budgeted_amount = db.Column(db.Float, nullable=False)
 
@@ -76,7 +103,7 @@ class Currency(db.Model):
 # Report Model
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     report_date = db.Column(db.DateTime, nullable=False)
     income_total = db.Column(db.Float, nullable=False)
     expense_total = db.Column(db.Float, nullable=False)
@@ -85,6 +112,6 @@ class Report(db.Model):
 # Notification Model
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     message = db.Column(db.String(255), nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,122 @@
+import threading
+import time
+from flask import current_app
+from flask.globals import app_ctx
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from models import db, User
+
+# Read-only session for GET handlers, scoped to the app context like db.session
+read_session = scoped_session(sessionmaker(autoflush=False), scopefunc=lambda: id(app_ctx._get_current_object()))
+
+# Last commit time per user id (int) and per table name (str), used for the
+# read-your-writes window. Entries are kept oldest first and dropped once the
+# window has passed.
+# This is per process; run sticky sessions if workers need to share it.
+_last_write = {}
+_last_write_lock = threading.Lock()
+
+# Engine options for the 'read' bind. Postgres replica connections start every
+# transaction read-only; SQLite ones are switched by set_read_only below.
+def read_bind(uri):
+    backend = make_url(uri).get_backend_name()
+    if backend == 'postgresql':
+        return {'url': uri, 'connect_args': {'options': '-c default_transaction_read_only=on'}}
+    if backend == 'sqlite':
+        return {'url': uri}
+    raise RuntimeError('Read replicas are only supported on SQLite and Postgres, not %s' % backend)
+
+# Set up the read engine and session. Call after db.init_app(app).
+def init_read_replica(app):
+    app.config.setdefault('SQLALCHEMY_READ_DATABASE_URI', None)
+    app.config.setdefault('READ_YOUR_WRITES_SECONDS', 0)
+    if not app.config['SQLALCHEMY_READ_DATABASE_URI']:
+        return
+
+    with app.app_context():
+        read_engine = db.engines['read']
+        write_engine = db.engine
+
+    # Refuse writes on SQLite replica connections. query_only is not undone by
+    # rollback, so it holds for the life of the pooled connection.
+    if read_engine.dialect.name == 'sqlite':
+        @event.listens_for(read_engine, 'connect')
+        def set_read_only(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA query_only = ON')
+            cursor.close()
+
+    # WAL lets SQLite readers run alongside the writer on the same file
+    if write_engine.dialect.name == 'sqlite':
+        @event.listens_for(write_engine, 'connect')
+        def set_wal(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.close()
+
+    read_session.session_factory.configure(bind=read_engine)
+    app.teardown_appcontext(lambda exc: read_session.remove())
+
+# True when reads may go to the replica and a read-your-writes window is set
+def _tracking_writes():
+    config = current_app.config
+    return bool(config['SQLALCHEMY_READ_DATABASE_URI']) and config['READ_YOUR_WRITES_SECONDS'] > 0
+
+# Return the session a GET handler should read from. Pass the user whose rows
+# are read, or the model for listings that span every user.
+def reader(user_id=None, model=None):
+    if not current_app.config['SQLALCHEMY_READ_DATABASE_URI']:
+        return db.session
+
+    # Serve recent writes to the user or table from the primary
+    window = current_app.config['READ_YOUR_WRITES_SECONDS']
+    if window:
+        keys = [model.__tablename__] if model is not None else []
+        if user_id is not None:
+            keys.append(int(user_id))
+        now = time.monotonic()
+        for key in keys:
+            last_write = _last_write.get(key)
+            if last_write is not None and now - last_write < window:
+                return db.session
+
+    return read_session
+
+# Collect the users and tables touched by each flush on the primary session
+@event.listens_for(db.session, 'after_flush')
+def collect_written_users(session, flush_context):
+    if not _tracking_writes():
+        return
+    written = session.info.setdefault('written_user_ids', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        written.add(obj.__tablename__)
+        user_id = obj.id if isinstance(obj, User) else getattr(obj, 'user_id', None)
+        # Handlers assign user_id straight from the JSON body, which may be a string
+        try:
+            written.add(int(user_id))
+        except (TypeError, ValueError):
+            pass
+
+@event.listens_for(db.session, 'after_commit')
+def record_written_users(session):
+    written = session.info.pop('written_user_ids', ())
+    if not written:
+        return
+    now = time.monotonic()
+    window = current_app.config['READ_YOUR_WRITES_SECONDS']
+    with _last_write_lock:
+        # Re-insert so the dict stays ordered by last write time
+        for key in written:
+            _last_write.pop(key, None)
+            _last_write[key] = now
+        while _last_write:
+            key, last_write = next(iter(_last_write.items()))
+            if now - last_write < window:
+                break
+            del _last_write[key]
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_written_users(session):
+    session.info.pop('written_user_ids', None)
@@ -1,13 +1,23 @@
 import functools
+import itertools
+import os
+import string
+import uuid
+import click
 from flask import Flask, request, jsonify, current_app, make_response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
 from flask_login import login_user, logout_user, login_required, current_user, LoginManager, UserMixin
 from datetime import datetime, timedelta  
+from werkzeug.security import check_password_hash
 
 
 # Import the models
 from models import db, User, UserProfile, Category, Transaction, Account, Budget, Currency, Report, Notification
+from replica import init_read_replica, read_bind, read_session, reader
+from auth import init_auth
 
 # Create a Flask app
 app = Flask(__name__)
@@ -16,8 +26,27 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.sqlite3'
 app.config['SECRET_KEY'] = 'your_secret_key_here'
 
+# Configure read/write splitting. GET handlers read from this database when it
+# is set, e.g. a Postgres replica or the same SQLite file opened read-only.
+app.config['SQLALCHEMY_READ_DATABASE_URI'] = os.environ.get('SQLALCHEMY_READ_DATABASE_URI') or None
+# Seconds after a user's own write during which their reads go to the primary
+app.config['READ_YOUR_WRITES_SECONDS'] = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 0))
+if app.config['SQLALCHEMY_READ_DATABASE_URI']:
+    app.config['SQLALCHEMY_BINDS'] = {'read': read_bind(app.config['SQLALCHEMY_READ_DATABASE_URI'])}
+
+# Configure authentication. When enabled, every route except user creation and
+# login requires a JWT from /login, validated without a database query.
+app.config['AUTH_ENABLED'] = os.environ.get('AUTH_ENABLED') == '1'
+# Key for signing tokens; required when auth is enabled
+app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
+app.config['AUTH_USER_CACHE_SECONDS'] = 60
+# Werkzeug hash method, e.g. 'scrypt' or 'pbkdf2:sha256:600000'; raise the cost to slow hashing
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+
 # Initialize the models
 db.init_app(app)
+init_read_replica(app)
+init_auth(app)
 
 # Create the database tables
 with app.app_context():
@@ -79,7 +108,7 @@ def delete_user(user_id):
 # Create a route for getting all users
 @app.route('/users', methods=['GET'])
 def get_all_users():
-    users = User.query.all()
+    users = reader(model=User).query(User).all()
 
     # Return a JSON response with all the users
     return jsonify({
@@ -100,9 +129,12 @@ def create_user():
     username = request.json['username']
     email = request.json['email']
     password = request.json['password']
+    if not isinstance(password, str):
+        return make_response(jsonify({'message': 'Password must be a string'}), 400)
 
     # Create a new user object
-    user = User(username=username, email=email, password=password)
+    user = User(username=username, email=email)
+    user.set_password(password)
 
     # Save the new user to the database
     db.session.add(user)
@@ -115,6 +147,28 @@ def create_user():
         'email': user.email
     })
 
+# Create a route for logging in and getting an access token
+@app.route('/login', methods=['POST'])
+@json_required
+def login():
+    password = request.json['password']
+    if not isinstance(password, str):
+        return make_response(jsonify({'message': 'Password must be a string'}), 400)
+
+    user = User.query.filter_by(username=request.json['username']).first()
+    if user is None:
+        # Spend as long as a real check so timing does not reveal which usernames exist
+        check_password_hash(User.dummy_password_hash(), password)
+        return make_response(jsonify({'message': 'Invalid username or password'}), 401)
+    if not user.check_password(password):
+        return make_response(jsonify({'message': 'Invalid username or password'}), 401)
+
+    # Save the password hash if it was upgraded
+    db.session.commit()
+
+    # Return a JSON response with the access token
+    return jsonify({'access_token': user.generate_access_token()})
+
 
 # Create a route for updating a transaction
 @app.route('/transaction/<int:transaction_id>', methods=['PUT'])
@@ -164,7 +218,7 @@ def delete_transaction(transaction_id):
 # Create a route for getting all transactions for a user
 @app.route('/user/<int:user_id>/transactions', methods=['GET'])
 def get_all_transactions_for_user(user_id):
-    transactions = Transaction.query.filter_by(user_id=user_id).all()
+    transactions = reader(user_id).query(Transaction).filter_by(user_id=user_id).all()
 
     # Return a JSON response with all the transactions for the user
     return jsonify({
@@ -239,7 +293,7 @@ def update_account(account_id):
 # Create a route for getting all accounts for a user
 @app.route('/user/<int:user_id>/accounts', methods=['GET'])
 def get_all_accounts_for_user(user_id):
-    accounts = Account.query.filter_by(user_id=user_id).all()
+    accounts = reader(user_id).query(Account).filter_by(user_id=user_id).all()
 
     # Return a JSON response with all the accounts for the user
     return jsonify({
@@ -322,7 +376,7 @@ def update_budget(budget_id):
 # Create a route for getting all budgets for a user
 @app.route('/user/<int:user_id>/budgets', methods=['GET'])
 def get_all_budgets_for_user(user_id):
-    budgets = Budget.query.filter_by(user_id=user_id).all()
+    budgets = reader(user_id).query(Budget).filter_by(user_id=user_id).all()
 
     # Return a JSON response with all the budgets for the user
     return jsonify({
@@ -401,7 +455,7 @@ def update_currency(currency_id):
 # Create a route for getting all currencies
 @app.route('/currencies', methods=['GET'])
 def get_all_currencies():
-    currencies = Currency.query.all()
+    currencies = reader(model=Currency).query(Currency).all()
 
     # Return a JSON response with all the currencies
     return jsonify({
@@ -482,7 +536,7 @@ def update_report(report_id):
 # Create a route for getting all reports for a user
 @app.route('/user/<int:user_id>/reports', methods=['GET'])
 def get_all_reports_for_user(user_id):
-    reports = Report.query.filter_by(user_id=user_id).all()
+    reports = reader(user_id).query(Report).filter_by(user_id=user_id).all()
 
     # Return a JSON response with all the reports for the user
     return jsonify({
@@ -569,7 +623,7 @@ def update_notification(notification_id):
 # Create a route for getting all notifications for a user
 @app.route('/user/<int:user_id>/notifications', methods=['GET'])
 def get_all_notifications_for_user(user_id):
-    notifications = Notification.query.filter_by(user_id=user_id).all()
+    notifications = reader(user_id).query(Notification).filter_by(user_id=user_id).all()
 
     # Return a JSON response with all the notifications for the user
     return jsonify({
@@ -623,6 +677,187 @@ def delete_notification(notification_id):
     # Return a JSON response with a success message
     return jsonify({'message': 'Notification deleted successfully'})
 
+# Create a CLI command that adds indexes missing from existing tables, which
+# db.create_all() skips. On Postgres they are built CONCURRENTLY so writes to
+# the table are not blocked while the index builds.
+@app.cli.command('create-indexes')
+def create_indexes():
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for table in db.metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                index.dialect_options['postgresql']['concurrently'] = True
+                try:
+                    # IF NOT EXISTS lets concurrent or repeated runs skip built indexes
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+                finally:
+                    index.dialect_options['postgresql']['concurrently'] = False
+                click.echo(index.name)
+
+# Endpoints that list a whole table by design. Every other route's queries
+# must be served by an index.
+FULL_LISTING_ENDPOINTS = {'get_all_users', 'get_all_currencies'}
+
+# Statement types worth explaining; inserts have no plan to check
+EXPLAINED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE')
+
+# Currency codes are only three letters, so hand out ones that are not taken
+def free_currency_codes(session):
+    taken = {code for (code,) in session.query(Currency.code)}
+    for letters in itertools.product(string.ascii_uppercase, repeat=3):
+        code = ''.join(letters)
+        if code not in taken:
+            yield code
+
+# Seed enough rows per user for the planner to prefer an index when one exists.
+# Returns a seeded user and the ids to fill route arguments with.
+def seed_explain_dataset(session, users=50, rows_per_user=20):
+    now = datetime.utcnow()
+    # Random suffix so seeded rows never clash with rows already in the database
+    suffix = uuid.uuid4().hex[:8]
+    category = Category(name='explain-queries-category-%s' % suffix)
+    session.add(category)
+    for i in range(users):
+        user = User(username='explain-user-%s-%d' % (suffix, i), email='explain-user-%s-%d@example.com' % (suffix, i), password='explain')
+        session.add(user)
+        session.flush()
+        session.add(UserProfile(user_id=user.id, profile_picture=b'', first_name='Explain'))
+        for j in range(rows_per_user):
+            rows = [
+                Transaction(user_id=user.id, transaction_date=now, description='seed', category_id=category.id, amount=j, is_income=j % 2 == 0),
+                Account(user_id=user.id, account_name='seed', account_type='seed', balance=j),
+                Budget(user_id=user.id, category='seed', budgeted_amount=j),
+                Report(user_id=user.id, report_date=now, income_total=j, expense_total=j, balance=0),
+                Notification(user_id=user.id, message='seed', timestamp=now),
+            ]
+            session.add_all(rows)
+    currency = Currency(code=next(free_currency_codes(session)), exchange_rate=1.0)
+    session.add(currency)
+    session.flush()
+
+    ids = {'user_id': user.id, 'category_id': category.id}
+    for row in rows + [currency]:
+        ids[row.__tablename__ + '_id'] = row.id
+    return user, ids
+
+# JSON body carrying every field any route reads, so each handler gets as far
+# as its queries
+def explain_request_body(session, user, ids):
+    now = datetime.utcnow().isoformat()
+    codes = free_currency_codes(session)
+    return {
+        'username': user.username, 'email': 'explain-%s@example.com' % uuid.uuid4().hex[:8], 'password': 'explain',
+        'first_name': 'Explain', 'last_name': 'Explain', 'phone_number': '0',
+        'user_id': user.id, 'category_id': ids['category_id'], 'transaction_date': now, 'description': 'explain',
+        'amount': 1, 'is_income': True, 'account_name': 'explain', 'account_type': 'explain', 'balance': 1,
+        'category': 'explain', 'budgeted_amount': 1, 'code': next(codes), 'exchange_rate': 1.0,
+        'report_date': now, 'income_total': 1, 'expense_total': 1, 'message': 'explain', 'timestamp': now,
+    }
+
+# Run EXPLAIN for a captured statement and report whether it plans a full table scan
+def explain_statement(connection, statement, parameters):
+    if connection.dialect.name == 'sqlite':
+        plan = [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+        full_scan = any(line.startswith('SCAN ') and ' USING ' not in line for line in plan)
+    else:
+        # ANALYZE executes the statement, so only use it for reads
+        prefix = 'EXPLAIN ANALYZE ' if statement.lstrip().upper().startswith('SELECT') else 'EXPLAIN '
+        plan = [row[0] for row in connection.exec_driver_sql(prefix + statement, parameters)]
+        full_scan = any('Seq Scan' in line for line in plan)
+    return plan, full_scan
+
+# Create a CLI command that sends a request to every route against a seeded
+# dataset, explains the statements each one issues, and fails when a hot
+# route plans a full table scan
+@app.cli.command('explain-queries')
+@click.option('--verbose', is_flag=True, help='Print the full plan for every statement.')
+def explain_queries(verbose):
+    failures = []
+    config = {key: app.config[key] for key in ('AUTH_ENABLED', 'PROPAGATE_EXCEPTIONS')}
+
+    # Everything runs in one transaction on one connection and is rolled back
+    connection = db.engine.connect()
+    sqlite = connection.dialect.name == 'sqlite'
+    if sqlite:
+        # pysqlite's own transaction handling breaks SAVEPOINT, so emit BEGIN ourselves
+        driver_connection = connection.connection.driver_connection
+        isolation_level = driver_connection.isolation_level
+        driver_connection.isolation_level = None
+        event.listen(connection, 'begin', lambda conn: conn.exec_driver_sql('BEGIN'))
+    transaction = connection.begin()
+
+    try:
+        session = Session(bind=connection, join_transaction_mode='create_savepoint')
+        user, ids = seed_explain_dataset(session)
+        body = explain_request_body(session, user, ids)
+        session.commit()
+        session.close()
+        if connection.dialect.name == 'postgresql':
+            # Small seeded tables would otherwise always plan a sequential scan
+            connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+
+        # Skip token checks and raise handler errors instead of logging them
+        app.config['AUTH_ENABLED'] = False
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+        client = app.test_client()
+        adapter = app.url_map.bind('localhost')
+
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: (rule.rule, rule.endpoint)):
+            if rule.endpoint == 'static':
+                continue
+            missing = rule.arguments - set(ids)
+            if missing:
+                raise click.ClickException('No seeded row for %s in route %s' % (', '.join(sorted(missing)), rule.rule))
+            url = adapter.build(rule.endpoint, {argument: ids[argument] for argument in rule.arguments})
+
+            for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+                statements = []
+
+                def capture(conn, cursor, statement, parameters, context, executemany):
+                    if statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+                        statements.append((statement, parameters[0] if executemany else parameters))
+
+                # Route both the primary and read sessions to the seeded
+                # connection, inside a savepoint undone after the request
+                savepoint = connection.begin_nested()
+                request_session = Session(bind=connection, join_transaction_mode='create_savepoint')
+                db.session.registry.set(request_session)
+                read_session.registry.set(request_session)
+                event.listen(connection, 'before_cursor_execute', capture)
+                try:
+                    status = client.open(url, method=method, json=body).status_code
+                except Exception as e:
+                    # Handlers may still fail after their queries, e.g. on constraints
+                    status = type(e).__name__
+                finally:
+                    event.remove(connection, 'before_cursor_execute', capture)
+                    request_session.close()
+                    savepoint.rollback()
+
+                plans = [(statement,) + explain_statement(connection, statement, parameters) for statement, parameters in statements]
+                failed = rule.endpoint not in FULL_LISTING_ENDPOINTS and any(full_scan for statement, plan, full_scan in plans)
+                if failed:
+                    failures.append(rule.endpoint)
+                result = 'FULL SCAN' if failed else 'ok' if plans else 'no reads'
+                click.echo('%-32s %-6s %-9s %s' % (rule.endpoint, method, result, status))
+                for statement, plan, full_scan in plans:
+                    if verbose or (failed and full_scan):
+                        click.echo('    ' + ' '.join(statement.split()))
+                        for line in plan:
+                            click.echo('        ' + line)
+    finally:
+        app.config.update(config)
+        db.session.registry.clear()
+        read_session.registry.clear()
+        # Throw away the seeded dataset
+        transaction.rollback()
+        if sqlite:
+            driver_connection.isolation_level = isolation_level
+        connection.close()
+
+    if failures:
+        raise click.ClickException('Full table scan planned for: ' + ', '.join(failures))
+
 # Start the Flask app
 if __name__ == '__main__':
     app.run(debug=True)